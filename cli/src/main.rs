@@ -1,5 +1,9 @@
 use failure::Error;
-use std::{fs, path::PathBuf};
+use std::{
+    fs::{self, File},
+    io::{BufWriter, Write},
+    path::PathBuf,
+};
 use structopt::StructOpt;
 use tm::TuringMachine;
 
@@ -38,8 +42,12 @@ fn tm_from_file(path: &PathBuf) -> Result<TuringMachine, Error> {
 }
 
 fn tm_to_file(tm: &TuringMachine, path: &PathBuf) -> Result<(), Error> {
-    let mut contents = format!("{}", tm);
-    fs::write(path, &mut contents)?;
+    // Stream the program straight to the file instead of building the whole
+    // source in memory first - compiled programs can get big
+    let mut writer = BufWriter::new(File::create(path)?);
+    write!(writer, "{}", tm)?;
+    // Flush explicitly - the implicit flush in Drop swallows I/O errors
+    writer.flush()?;
     Ok(())
 }
 
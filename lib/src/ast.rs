@@ -20,7 +20,7 @@ pub type StateId = usize;
 /// This is not the most common way of defining a TM (usually you write AND
 /// move in each transition), but this is how KG taught us, and who am I to
 /// question him.
-#[derive(Debug, Serialize, Deserialize)]
+#[derive(Copy, Clone, Debug, PartialEq, Eq, Serialize, Deserialize)]
 pub enum TapeInstruction {
     Left,
     Right,
@@ -28,8 +28,9 @@ pub enum TapeInstruction {
 }
 
 /// One transition, defined by a (state, char) pair. This consists of a tape
-/// instruction, and a destination state.
-#[derive(Debug, Serialize, Deserialize)]
+/// instruction, and a destination state. Transitions are small plain values,
+/// so they can be copied around freely instead of chased through references.
+#[derive(Copy, Clone, Debug, PartialEq, Eq, Serialize, Deserialize)]
 pub struct Transition {
     /// The character on the tape that triggers this transition
     pub match_char: AsciiChar,
@@ -1,41 +1,40 @@
+//! Stack machine codegen logic. There are many places where we want to
+//! document the expected machine state, so we'll standardize a way of
+//! specifying that:
+//!
+//! var_a: A
+//! var_i: I
+//! - X
+//! - Y
+//! - ...L
+//!
+//! - `A` is the active variable
+//! - `I` is the inactive variable
+//! - `X` is a single element, on top of the stack
+//! - `Y` is a single element, below `X` on the stack
+//! - `L` is a list of elements that fills the rest of the stack
+//!
+//! Also, the term "head char" refers to the character on the tape that's
+//! under the head of the machine.
+//!
+//! The general strategy used here, and almost all of the Rocketlang code, was
+//! created by Dr. Kevin Gold. The strategy is to simulate a two-stack PDA by
+//! essentially encoding one stack as a single number and passing that around
+//! between the two variables and the stack. Generally speaking, the stack
+//! holds the right half of the tape, including the piece under the head, and
+//! one of the variables holds the left half of the tape, encoded as a single
+//! int. Obviously, all the data has to get passed around a lot to be able to
+//! make room for computations.
+//!
+//! I've made some modifications to KG's code where necessary.
+
 use crate::{
     ast::{Program, State, TapeInstruction, Transition, ALPHABET_SIZE},
     stack::SmInstruction::{self, *},
     validate::Valid,
 };
-use ascii::AsciiChar;
 use itertools::Itertools;
-use std::{collections::HashMap, iter};
-
-/// Stack machine codegen logic. There are many places where we want to
-/// document the expected machine state, so we'll standardize a way of
-/// specifying that:
-///
-/// var_a: A
-/// var_i: I
-/// - X
-/// - Y
-/// - ...L
-///
-/// - `A` is the active variable
-/// - `I` is the inactive variable
-/// - `X` is a single element, on top of the stack
-/// - `Y` is a single element, below `X` on the stack
-/// - `L` is a list of elements that fills the rest of the stack
-///
-/// Also, the term "head char" refers to the character on the tape that's
-/// under the head of the machine.
-///
-/// The general strategy used here, and almost all of the Rocketlang code, was
-/// created by Dr. Kevin Gold. The strategy is to simulate a two-stack PDA by
-/// essentially encoding one stack as a single number and passing that around
-/// between the two variables and the stack. Generally speaking, the stack holds
-/// the right half of the tape, including the piece under the head, and one of
-/// the variables holds the left half of the tape, encoded as a single int.
-/// Obviously, all the data has to get passed around a lot to be able to make
-/// room for computations.
-///
-/// I've made some modifications to KG's code where necessary.
+use std::iter;
 
 macro_rules! state_comment {
     ( $active:expr, $inactive:expr, [$( $se:expr ),*] ) => {
@@ -340,10 +339,14 @@ impl Compile for [Transition] {
         // to decr from the head char, but then we're trashing it unnecessarily
         // and need to include extra Incrs to get it back.
 
-        let keyed_by_char: HashMap<AsciiChar, &Transition> = self
-            .iter()
-            .map(|transition| (transition.match_char, transition))
-            .collect();
+        // Index the transitions by char value, so the loop below can do a
+        // plain array lookup - no hashing, and no fallible char conversion
+        let mut keyed_by_char: Vec<Option<&Transition>> =
+            vec![None; ALPHABET_SIZE as usize];
+        for transition in self {
+            keyed_by_char[transition.match_char.as_byte() as usize] =
+                Some(transition);
+        }
 
         // For every char in the range we want to check, if there is a
         // transition for that char, add code for the transition. For EVERY
@@ -355,11 +358,7 @@ impl Compile for [Transition] {
                 // just add an Incr and move on.
                 let mut instrs = Vec::new();
 
-                // This to-char conversion should never fail because we're
-                // only doing this for valid ASCII chars.
-                if let Some(transition) =
-                    keyed_by_char.get(&AsciiChar::from(c).unwrap())
-                {
+                if let Some(transition) = keyed_by_char[c as usize] {
                     instrs.append(&mut vec![
                         Comment(format!("Transition for char={}", c)),
                         If(transition.compile()),
@@ -486,11 +485,22 @@ impl Compile for TapeInstruction {
             // Therefore:
             // H = R
             // LT' = x - 1
+
+            // One catch: EQ2 only holds if the loop overshoots, i.e. actually
+            // goes negative. If LT is an exact multiple of SIZE (H = 0, e.g.
+            // the left tape is empty), the loop exits at exactly 0 with no
+            // extra subtraction, and the math above comes out one off. So we
+            // divide LT + 1 instead - the remainder lands in [1, SIZE], the
+            // overshoot always happens, and we subtract the 1 back out of R
+            // afterwards. x = ceil((LT + 1) / SIZE) = LT' + 1 in every case,
+            // so the LT' = x - 1 step below still holds.
             TapeInstruction::Left => vec![
                 Comment("Move left".into()),
                 PushZero,
                 PopToActive,
                 Swap,
+                // Divide LT + 1, per the comment above
+                IncrActive,
                 While(
                     // State before each iteration:
                     // var_a: Left tape (partially divided)
@@ -512,10 +522,12 @@ impl Compile for TapeInstruction {
             // Add SIZE back to the remainder to get the new Head value
             .chain(iter::repeat(IncrActive).take(ALPHABET_SIZE as usize))
             // This won't terminate until LT goes negative, so state is:
-            // var_a: LT remainder (i.e. NEW head char)
+            // var_a: LT remainder (i.e. NEW head char, plus the 1 we added)
             // var_i: Decr counter (# of times we subtracted SIZE from LT)
             // - ...Right tape
             .chain(vec![
+                // Undo the +1 from before the division
+                DecrActive,
                 // Push new head char, then reset that counter to 0
                 PushActive, Swap,
                 // Now var_a holds the number of times we subtracted SIZE. That
@@ -535,39 +547,49 @@ impl Compile for TapeInstruction {
                 // enough.
 
                 // We need to save a copy of the original value of LT because
-                // we'll be adding it over and over again. Call this LT_O
-                vec![Comment("Move right".into()), Swap, PushActive]
-                    .into_iter()
-                    .chain(
-                        // State before each While loop:
-                        // var_a: Left tape original
-                        // var_i: Left tape (partially divided)
-                        // - Left tape original
-                        // - ...Right tape
-                        iter::repeat(vec![
-                            // Add LT_O to var_i
-                            While(vec![DecrActive, Swap, IncrActive, Swap]),
-                            // Reload LT_O from the stack into var_a
-                            PopToActive,
-                            PushActive,
-                        ])
-                        .take((ALPHABET_SIZE - 1) as usize)
-                        .flatten(),
-                    )
-                    // Now get rid of LT_O and put the head char back in var_a,
-                    // then add its value to the lowest n  bits of the left tape
-                    .chain(vec![
-                        state_comment!(
-                            "0",
-                            "Left tape",
-                            ["Left tape original", "Head", "...Right tape"]
-                        ),
-                        Comment("Add old head to left tape".into()),
-                        PopToActive, // Pop off LT_O
-                        PopToActive,
+                // we'll be adding it over and over again. Call this LT_O.
+                // The SaveActive seeds the accumulator in var_i with LT - at
+                // entry var_i holds the old head char, not LT, so without it
+                // the (SIZE - 1) transfer loops below would pile onto the
+                // wrong starting value. Seeded with LT, they leave
+                // SIZE * LT, ready for the head char to be added in.
+                vec![
+                    Comment("Move right".into()),
+                    Swap,
+                    SaveActive,
+                    PushActive,
+                ]
+                .into_iter()
+                .chain(
+                    // State before each While loop:
+                    // var_a: Left tape original
+                    // var_i: Left tape (partially multiplied)
+                    // - Left tape original
+                    // - ...Right tape
+                    iter::repeat(vec![
+                        // Add LT_O to var_i
                         While(vec![DecrActive, Swap, IncrActive, Swap]),
+                        // Reload LT_O from the stack into var_a
+                        PopToActive,
+                        PushActive,
                     ])
-                    .collect()
+                    .take((ALPHABET_SIZE - 1) as usize)
+                    .flatten(),
+                )
+                // Now get rid of LT_O and put the head char back in var_a,
+                // then add its value to the lowest n  bits of the left tape
+                .chain(vec![
+                    state_comment!(
+                        "0",
+                        "Left tape",
+                        ["Left tape original", "Head", "...Right tape"]
+                    ),
+                    Comment("Add old head to left tape".into()),
+                    PopToActive, // Pop off LT_O
+                    PopToActive,
+                    While(vec![DecrActive, Swap, IncrActive, Swap]),
+                ])
+                .collect()
             }
 
             TapeInstruction::Write(c) => {
@@ -0,0 +1,246 @@
+use crate::{
+    ast::{Program, StateId, TapeInstruction, ALPHABET_SIZE, BLANK_CHAR},
+    validate::Valid,
+};
+use ascii::AsciiStr;
+use failure::Error;
+use std::{collections::VecDeque, io::Write};
+
+/// The tape action for a step. Same as `TapeInstruction`, except the written
+/// char is pre-decoded to a raw byte to match the tape.
+#[derive(Copy, Clone, Debug)]
+enum StepAction {
+    Left,
+    Right,
+    Write(u8),
+}
+
+/// One transition, resolved down to exactly what the executor needs at each
+/// step: the pre-decoded tape action and the destination state. Resolving
+/// this once at construction time means the step loop never has to touch the
+/// AST again, and `Copy` means each step reads plain values out of the table
+/// with no indirection.
+#[derive(Copy, Clone, Debug)]
+struct Step {
+    action: StepAction,
+    next_state: StateId,
+}
+
+/// Executes a Turing machine program directly, without going through the
+/// stack-machine encoding. The stack-machine path (see `compile`) is what
+/// proves that Rocketlang is Turing-complete, but simulating a tape as a
+/// single unary-encoded int makes it intractably slow. This executor is the
+/// fast path: it interprets the validated program as-is, one transition
+/// lookup per step.
+///
+/// The semantics here must exactly match the compiled stack-machine program:
+/// the input is expected in reverse order, the machine halts when the current
+/// state has no transition for the head char, and the verdict is that state's
+/// accepting flag.
+#[derive(Debug)]
+pub struct Executor {
+    /// Fully materialized transition table, indexed by
+    /// `state_id * ALPHABET_SIZE + head_byte`. `None` means there is no
+    /// transition for that pair, i.e. the machine halts. State IDs are
+    /// sequential (starting at 1), so the table stays dense.
+    table: Vec<Option<Step>>,
+    /// Bitmap of accepting states, indexed by state ID
+    accepting_states: Vec<bool>,
+    /// ID of the initial state
+    initial_state: StateId,
+}
+
+impl Executor {
+    /// Builds an executor for the given (already validated) program.
+    pub fn new(program: &Valid<Program>) -> Self {
+        let max_state_id = program
+            .states
+            .iter()
+            .map(|state| state.id)
+            .max()
+            .unwrap_or(0);
+        let mut table = Vec::new();
+        table.resize_with(
+            (max_state_id + 1) * (ALPHABET_SIZE as usize),
+            || None,
+        );
+
+        let mut accepting_states = vec![false; max_state_id + 1];
+        let mut initial_state = 0;
+        for state in &program.states {
+            if state.initial {
+                initial_state = state.id;
+            }
+            if state.accepting {
+                accepting_states[state.id] = true;
+            }
+            for transition in &state.transitions {
+                let index = state.id * (ALPHABET_SIZE as usize)
+                    + transition.match_char.as_byte() as usize;
+                let action = match &transition.tape_instruction {
+                    TapeInstruction::Left => StepAction::Left,
+                    TapeInstruction::Right => StepAction::Right,
+                    TapeInstruction::Write(c) => {
+                        StepAction::Write(c.as_byte())
+                    }
+                };
+                table[index] = Some(Step {
+                    action,
+                    next_state: transition.next_state,
+                });
+            }
+        }
+        Self {
+            table,
+            accepting_states,
+            initial_state,
+        }
+    }
+
+    /// Runs the program on the given input. Like the stack-machine path, the
+    /// input is expected to be reversed, so the tape is the input reversed
+    /// back. Writes "ACCEPT" or "REJECT" to the output when the machine
+    /// halts. If the machine never halts, neither does this function.
+    pub fn run<W: Write>(
+        &self,
+        input: &AsciiStr,
+        output: &mut W,
+    ) -> Result<(), Error> {
+        // The compiled program reads the input onto the stack, which reverses
+        // it, so the logical tape is the reverse of the input string. The
+        // tape holds raw bytes - one byte per cell, no char wrappers. A
+        // deque makes growth on the left edge O(1), where a vec would have
+        // to shift the whole tape over.
+        let blank = BLANK_CHAR.as_byte();
+        let mut tape: VecDeque<u8> =
+            input.as_bytes().iter().rev().cloned().collect();
+        // Make sure there's always at least one cell for the head to read
+        if tape.is_empty() {
+            tape.push_back(blank);
+        }
+
+        // Bind everything the loop needs up front, so each step only touches
+        // locals
+        let table = &self.table;
+        let alphabet_size = ALPHABET_SIZE as usize;
+        let mut state = self.initial_state;
+        let mut head: usize = 0;
+        // Cache the table row for the current state. The state changes far
+        // less often than the head char, so most steps only index the row.
+        let mut row =
+            &table[state * alphabet_size..(state + 1) * alphabet_size];
+        loop {
+            match row[tape[head] as usize] {
+                // No transition for this (state, char) - halt
+                None => break,
+                Some(step) => {
+                    match step.action {
+                        StepAction::Left => {
+                            // The tape is infinite to the left - grow it on
+                            // demand with blanks
+                            if head == 0 {
+                                tape.push_front(blank);
+                            } else {
+                                head -= 1;
+                            }
+                        }
+                        StepAction::Right => {
+                            // Same as above, but on the right
+                            head += 1;
+                            if head == tape.len() {
+                                tape.push_back(blank);
+                            }
+                        }
+                        StepAction::Write(b) => {
+                            tape[head] = b;
+                        }
+                    }
+                    if step.next_state != state {
+                        state = step.next_state;
+                        row = &table[state * alphabet_size
+                            ..(state + 1) * alphabet_size];
+                    }
+                }
+            }
+        }
+
+        let result = if self.accepting_states[state] {
+            "ACCEPT"
+        } else {
+            "REJECT"
+        };
+        writeln!(output, "{}", result)?;
+        Ok(())
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use crate::{
+        ast::{State, Transition},
+        validate::Validate,
+    };
+    use ascii::AsciiChar;
+    use std::str::FromStr;
+
+    fn run_executor(program: Program, input: &str) -> String {
+        let valid = program.validate_into(&()).unwrap();
+        let executor = Executor::new(&valid);
+        let mut output = Vec::new();
+        let ascii_str = ascii::AsciiString::from_str(input).unwrap();
+        executor.run(&ascii_str, &mut output).unwrap();
+        String::from_utf8(output).unwrap()
+    }
+
+    fn single_char_machine() -> Program {
+        // Matches exactly the string "a"
+        Program {
+            states: vec![
+                State {
+                    id: 1,
+                    initial: true,
+                    accepting: false,
+                    transitions: vec![Transition {
+                        match_char: AsciiChar::a,
+                        tape_instruction: TapeInstruction::Right,
+                        next_state: 2,
+                    }],
+                },
+                State {
+                    id: 2,
+                    initial: false,
+                    accepting: false,
+                    transitions: vec![Transition {
+                        match_char: AsciiChar::Null,
+                        tape_instruction: TapeInstruction::Right,
+                        next_state: 3,
+                    }],
+                },
+                State {
+                    id: 3,
+                    initial: false,
+                    accepting: true,
+                    transitions: vec![],
+                },
+            ],
+        }
+    }
+
+    #[test]
+    fn test_accept() {
+        assert_eq!(run_executor(single_char_machine(), "a"), "ACCEPT\n");
+    }
+
+    #[test]
+    fn test_reject() {
+        assert_eq!(run_executor(single_char_machine(), "b"), "REJECT\n");
+    }
+
+    #[test]
+    fn test_empty_input() {
+        // An empty input reads as a blank head char, which has no transition
+        // from the initial state, so the machine halts immediately
+        assert_eq!(run_executor(single_char_machine(), ""), "REJECT\n");
+    }
+}
@@ -3,6 +3,7 @@
 mod ast;
 mod compile;
 mod error;
+mod exec;
 mod rocketlang;
 mod stack;
 mod turing;
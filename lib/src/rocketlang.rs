@@ -1,43 +1,60 @@
 use crate::stack::SmInstruction;
-use itertools::Itertools;
 
 trait ToRocketlang {
-    fn to_rocketlang(&self) -> String;
+    /// Emits this as rocketlang source, appending onto the given buffer.
+    /// Every node writes into the one shared buffer, so emitting a whole
+    /// program does a handful of allocations instead of one String per node.
+    fn emit_rocketlang(&self, buffer: &mut String);
+
+    /// Converts this to a standalone rocketlang source string.
+    fn to_rocketlang(&self) -> String {
+        let mut buffer = String::new();
+        self.emit_rocketlang(&mut buffer);
+        buffer
+    }
 }
 
 impl<R: ToRocketlang> ToRocketlang for Vec<R> {
-    fn to_rocketlang(&self) -> String {
-        self.iter().map(R::to_rocketlang).join("\n")
+    fn emit_rocketlang(&self, buffer: &mut String) {
+        for (i, instruction) in self.iter().enumerate() {
+            if i > 0 {
+                buffer.push('\n');
+            }
+            instruction.emit_rocketlang(buffer);
+        }
     }
 }
 
 impl ToRocketlang for SmInstruction {
-    fn to_rocketlang(&self) -> String {
+    fn emit_rocketlang(&self, buffer: &mut String) {
         match self {
-            SmInstruction::ReadToActive => "Take the shot!".to_owned(),
-            SmInstruction::PrintActive => "I got it!".to_owned(),
-            SmInstruction::PrintState => "Sorry!".to_owned(),
-            SmInstruction::IncrActive => "Wow!".to_owned(),
-            SmInstruction::DecrActive => "Close one!".to_owned(),
-            SmInstruction::SaveActive => "Whoops...".to_owned(),
-            SmInstruction::Swap => "OMG!".to_owned(),
-            SmInstruction::PushZero => "Noooo!".to_owned(),
-            SmInstruction::PushActive => "Defending...".to_owned(),
-            SmInstruction::PopToActive => "Centering...".to_owned(),
-            SmInstruction::ToggleErrors => "No Problem.".to_owned(),
-            SmInstruction::If(subinstrs) => format!(
-                "Nice shot!\n{}\nWhat a save!",
-                subinstrs.to_rocketlang()
-            ),
+            SmInstruction::ReadToActive => buffer.push_str("Take the shot!"),
+            SmInstruction::PrintActive => buffer.push_str("I got it!"),
+            SmInstruction::PrintState => buffer.push_str("Sorry!"),
+            SmInstruction::IncrActive => buffer.push_str("Wow!"),
+            SmInstruction::DecrActive => buffer.push_str("Close one!"),
+            SmInstruction::SaveActive => buffer.push_str("Whoops..."),
+            SmInstruction::Swap => buffer.push_str("OMG!"),
+            SmInstruction::PushZero => buffer.push_str("Noooo!"),
+            SmInstruction::PushActive => buffer.push_str("Defending..."),
+            SmInstruction::PopToActive => buffer.push_str("Centering..."),
+            SmInstruction::ToggleErrors => buffer.push_str("No Problem."),
+            SmInstruction::If(subinstrs) => {
+                buffer.push_str("Nice shot!\n");
+                subinstrs.emit_rocketlang(buffer);
+                buffer.push_str("\nWhat a save!");
+            }
             SmInstruction::While(subinstrs) => {
-                format!("Great pass!\n{}\nThanks!", subinstrs.to_rocketlang())
+                buffer.push_str("Great pass!\n");
+                subinstrs.emit_rocketlang(buffer);
+                buffer.push_str("\nThanks!");
             }
             // Rocketlang has no syntax for comments so we can't do anything
-            SmInstruction::Comment(_) => String::new(),
+            SmInstruction::Comment(_) => {}
             SmInstruction::InlineComment(subinstr, _) => {
-                subinstr.to_rocketlang()
+                subinstr.emit_rocketlang(buffer)
             }
-            SmInstruction::DebugPrint(_,_) => String::new(),
+            SmInstruction::DebugPrint(_, _) => {}
         }
     }
 }
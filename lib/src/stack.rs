@@ -8,6 +8,11 @@ use std::{
 /// so this gives us 9 chars with one extra bit for the sign.
 type Value = i64;
 
+/// Initial capacity of the machine's stack. Preallocating skips the
+/// repeated grow-and-copy churn while the input gets read onto the stack.
+/// The stack can still grow past this if it needs to.
+const INITIAL_STACK_CAPACITY: usize = 1024;
+
 /// One step to run on the stack machine
 #[derive(Clone, Debug, Serialize)]
 pub enum SmInstruction {
@@ -150,6 +155,270 @@ impl Display for SmInstruction {
     }
 }
 
+/// One op in the flattened form of a stack-machine program. This is what the
+/// machine actually executes: the `If`/`While` tree structure is compiled
+/// down to conditional jumps over a flat op array, so execution is a plain
+/// program-counter loop with no recursion and no per-step tree traversal.
+/// Comments are stripped during flattening since they're no-ops.
+///
+/// Ops are deliberately small `Copy` values - debug messages live in a side
+/// table on `FlatProgram` - so the op array stays dense and cache-friendly.
+#[derive(Copy, Clone, Debug)]
+enum FlatOp {
+    ReadToActive,
+    PrintActive,
+    PrintState,
+    /// Adds the given delta to the active variable. `IncrActive` and
+    /// `DecrActive` compile to this; adjacent runs of them get folded into a
+    /// single add at flatten time, which matters a lot because the TM
+    /// compiler encodes chars and state IDs as long unary runs of
+    /// increments.
+    AddActive(Value),
+    SaveActive,
+    Swap,
+    PushZero,
+    PushActive,
+    PopToActive,
+    /// Resets the active variable to 0. The instruction set can only do this
+    /// via `PushZero, PopToActive`; flattening fuses that pair into this op
+    /// so the reset never touches the stack.
+    SetActiveZero,
+    ToggleErrors,
+    /// Jump to the target pc iff active_var != inactive_var. Compiled from
+    /// the top of an `If`.
+    JumpIfNe(usize),
+    /// Jump to the target pc iff active_var <= 0. Compiled from the top of a
+    /// `While`.
+    JumpIfNonPos(usize),
+    /// Unconditional jump to the target pc. Compiled from the back-edge of a
+    /// `While`.
+    Jump(usize),
+    /// Runs `while active > 0 { active -= decr; inactive += incr }` in
+    /// closed form. Compiled from While bodies of that shape, which is how
+    /// the TM compiler does all of its arithmetic (adding, and dividing by
+    /// the alphabet size, one subtraction at a time). Executing the loop
+    /// naively takes O(active_var) iterations, and the encoded tape value
+    /// grows exponentially with tape length, so this op is the difference
+    /// between tractable and not.
+    FusedLoopAdd { decr: Value, incr: Value },
+    /// Closed form of a While loop whose body just pushes zeros and counts
+    /// the active variable down: `zeros` zeros get pushed per iteration, in
+    /// one bulk stack fill. This is the stack-zeroing idiom.
+    FusedLoopPushZero { decr: Value, zeros: usize },
+    /// Print a debug message to stdout. The message is an index into the
+    /// program's debug-message table.
+    DebugPrint(usize, bool),
+}
+
+/// A flattened, executable stack-machine program. See `FlatOp`. Flattening
+/// only has to happen once per program; the result can be executed any
+/// number of times via `StackMachine::run_compiled`.
+#[derive(Clone, Debug)]
+pub struct FlatProgram {
+    ops: Vec<FlatOp>,
+    /// Debug messages referenced by `DebugPrint` ops, stored out of line to
+    /// keep the ops themselves small
+    debug_msgs: Vec<String>,
+    /// Flatten-time bookkeeping: ops at indexes below this can't be merged
+    /// with newly emitted ops. This marks jump targets, so that e.g. an
+    /// increment following an If never gets folded into the If's body.
+    fold_barrier: usize,
+}
+
+impl FlatProgram {
+    /// Flattens a tree of instructions into an executable program.
+    pub fn flatten(instructions: &[SmInstruction]) -> Self {
+        let mut program = Self {
+            ops: Vec::new(),
+            debug_msgs: Vec::new(),
+            fold_barrier: 0,
+        };
+        program.flatten_into(instructions);
+        // Compiled programs are long-lived (TuringMachine holds one for its
+        // whole life), so give back the grow-slack
+        program.ops.shrink_to_fit();
+        program.debug_msgs.shrink_to_fit();
+        program
+    }
+
+    /// Tries to match a While body of the shape
+    /// `[DecrActive * n, Swap, IncrActive * m, Swap]` - a loop that streams
+    /// value out of the active var and into the inactive var. Returns
+    /// `(n, m)` on a match. A body of bare decrements (the countdown idiom)
+    /// also matches, as `(n, 0)`. Comments are ignored, since they don't
+    /// execute.
+    fn match_add_loop(body: &[SmInstruction]) -> Option<(Value, Value)> {
+        let mut decr = 0;
+        let mut incr = 0;
+        // Tiny state machine: 0 = counting decrs, 1 = counting incrs,
+        // 2 = matched the closing Swap
+        let mut phase = 0;
+        for instruction in body {
+            let instruction = match instruction {
+                SmInstruction::Comment(_) => continue,
+                SmInstruction::InlineComment(subinstr, _) => &**subinstr,
+                other => other,
+            };
+            match (phase, instruction) {
+                (0, SmInstruction::DecrActive) => decr += 1,
+                (0, SmInstruction::Swap) if decr > 0 => phase = 1,
+                (1, SmInstruction::IncrActive) => incr += 1,
+                (1, SmInstruction::Swap) if incr > 0 => phase = 2,
+                _ => return None,
+            }
+        }
+        match phase {
+            // Never saw a Swap - a pure countdown loop
+            0 if decr > 0 => Some((decr, 0)),
+            2 => Some((decr, incr)),
+            _ => None,
+        }
+    }
+
+    /// Tries to match a While body made up of only PushZero and DecrActive -
+    /// a loop that fills the stack with zeros while counting the active var
+    /// down. Returns the per-iteration `(decr, zeros)` counts on a match.
+    /// Comments are ignored, since they don't execute.
+    fn match_zero_fill_loop(body: &[SmInstruction]) -> Option<(Value, usize)> {
+        let mut decr = 0;
+        let mut zeros = 0;
+        for instruction in body {
+            let instruction = match instruction {
+                SmInstruction::Comment(_) => continue,
+                SmInstruction::InlineComment(subinstr, _) => &**subinstr,
+                other => other,
+            };
+            match instruction {
+                SmInstruction::DecrActive => decr += 1,
+                SmInstruction::PushZero => zeros += 1,
+                _ => return None,
+            }
+        }
+        if decr > 0 && zeros > 0 {
+            Some((decr, zeros))
+        } else {
+            None
+        }
+    }
+
+    /// Emits an op to add the given delta to the active variable, folding
+    /// into the previous op if that was also an add. An add that folds to
+    /// zero (an Incr/Decr pair) gets dropped entirely.
+    fn push_add(&mut self, delta: Value) {
+        if self.ops.len() > self.fold_barrier {
+            if let Some(FlatOp::AddActive(prev)) = self.ops.last_mut() {
+                *prev += delta;
+                if *prev == 0 {
+                    self.ops.pop();
+                }
+                return;
+            }
+        }
+        self.ops.push(FlatOp::AddActive(delta));
+    }
+
+    /// Recursive helper for `flatten`. Appends ops for the given
+    /// instructions onto the program.
+    fn flatten_into(&mut self, instructions: &[SmInstruction]) {
+        for instruction in instructions {
+            match instruction {
+                SmInstruction::ReadToActive => {
+                    self.ops.push(FlatOp::ReadToActive)
+                }
+                SmInstruction::PrintActive => {
+                    self.ops.push(FlatOp::PrintActive)
+                }
+                SmInstruction::PrintState => {
+                    self.ops.push(FlatOp::PrintState)
+                }
+                SmInstruction::IncrActive => self.push_add(1),
+                SmInstruction::DecrActive => self.push_add(-1),
+                SmInstruction::SaveActive => {
+                    self.ops.push(FlatOp::SaveActive)
+                }
+                SmInstruction::Swap => {
+                    // Two Swaps in a row cancel out entirely
+                    if self.ops.len() > self.fold_barrier {
+                        if let Some(FlatOp::Swap) = self.ops.last() {
+                            self.ops.pop();
+                            continue;
+                        }
+                    }
+                    self.ops.push(FlatOp::Swap)
+                }
+                SmInstruction::PushZero => self.ops.push(FlatOp::PushZero),
+                SmInstruction::PushActive => {
+                    self.ops.push(FlatOp::PushActive)
+                }
+                SmInstruction::PopToActive => {
+                    // `PushZero, PopToActive` is the reset-to-zero idiom;
+                    // fuse the pair so it doesn't touch the stack at all
+                    if self.ops.len() > self.fold_barrier {
+                        if let Some(op @ FlatOp::PushZero) =
+                            self.ops.last_mut()
+                        {
+                            *op = FlatOp::SetActiveZero;
+                            continue;
+                        }
+                    }
+                    self.ops.push(FlatOp::PopToActive)
+                }
+                SmInstruction::ToggleErrors => {
+                    self.ops.push(FlatOp::ToggleErrors)
+                }
+                SmInstruction::If(subinstrs) => {
+                    // Jump over the body iff the If doesn't match. The target
+                    // isn't known until the body is flattened, so patch it in
+                    // after.
+                    let jump_index = self.ops.len();
+                    self.ops.push(FlatOp::JumpIfNe(0));
+                    self.flatten_into(subinstrs);
+                    self.ops[jump_index] = FlatOp::JumpIfNe(self.ops.len());
+                    self.fold_barrier = self.ops.len();
+                }
+                SmInstruction::While(subinstrs) => {
+                    // Unary arithmetic loops get emitted in closed form
+                    // instead of actually looping
+                    if let Some((decr, incr)) =
+                        Self::match_add_loop(subinstrs)
+                    {
+                        self.ops.push(FlatOp::FusedLoopAdd { decr, incr });
+                        continue;
+                    }
+                    if let Some((decr, zeros)) =
+                        Self::match_zero_fill_loop(subinstrs)
+                    {
+                        self.ops
+                            .push(FlatOp::FusedLoopPushZero { decr, zeros });
+                        continue;
+                    }
+
+                    // Same as If, plus an unconditional jump back to the
+                    // condition check at the bottom of the body
+                    let jump_index = self.ops.len();
+                    self.ops.push(FlatOp::JumpIfNonPos(0));
+                    self.flatten_into(subinstrs);
+                    self.ops.push(FlatOp::Jump(jump_index));
+                    self.ops[jump_index] =
+                        FlatOp::JumpIfNonPos(self.ops.len());
+                    self.fold_barrier = self.ops.len();
+                }
+                // Comments don't execute anything
+                SmInstruction::Comment(_) => {}
+                SmInstruction::InlineComment(subinstr, _) => {
+                    self.flatten_into(std::slice::from_ref(&**subinstr));
+                }
+                SmInstruction::DebugPrint(msg, print_stack) => {
+                    let msg_index = self.debug_msgs.len();
+                    self.debug_msgs.push(msg.clone());
+                    self.ops
+                        .push(FlatOp::DebugPrint(msg_index, *print_stack));
+                }
+            }
+        }
+    }
+}
+
 /// A direct equivalent of the rocketlang interpreter, equally as powerful.
 /// All other machines must be built on top of this, so we know they can be
 /// built in rocketlang.
@@ -167,7 +436,7 @@ impl StackMachine {
         Self {
             active_var: 0,
             inactive_var: 0,
-            stack: Vec::new(),
+            stack: Vec::with_capacity(INITIAL_STACK_CAPACITY),
             errors_enabled: true,
         }
     }
@@ -179,18 +448,14 @@ impl StackMachine {
     }
 
     fn write_stack<W: Write>(&self, writer: &mut W) -> io::Result<()> {
-        writer.write_all(
-            format!(
-                "Active: {}\nInactive: {}\n",
-                self.active_var, self.inactive_var,
-            )
-            .as_bytes(),
-        )?;
-        writer.write_all("-----\n".as_bytes())?;
+        // Format straight into the writer - no intermediate strings
+        writeln!(writer, "Active: {}", self.active_var)?;
+        writeln!(writer, "Inactive: {}", self.inactive_var)?;
+        writeln!(writer, "-----")?;
         for e in self.stack.iter().rev() {
-            writer.write_all(&format!("- {}\n", e).as_bytes())?;
+            writeln!(writer, "- {}", e)?;
         }
-        writer.write_all("\n".as_bytes())?;
+        writeln!(writer)?;
         Ok(())
     }
 
@@ -226,24 +491,6 @@ impl StackMachine {
         }
     }
 
-    fn incr(&mut self) {
-        self.active_var += 1;
-    }
-    fn decr(&mut self) {
-        self.active_var -= 1;
-    }
-    fn save_active(&mut self) {
-        self.inactive_var = self.active_var;
-    }
-    fn swap(&mut self) {
-        std::mem::swap(&mut self.active_var, &mut self.inactive_var);
-    }
-    fn push_zero(&mut self) {
-        self.stack.push(0);
-    }
-    fn push_active(&mut self) {
-        self.stack.push(self.active_var);
-    }
     fn pop_to_active(&mut self) {
         match self.stack.pop() {
             Some(val) => {
@@ -256,105 +503,134 @@ impl StackMachine {
             }
         }
     }
-    fn toggle_errors(&mut self) {
-        self.errors_enabled = !self.errors_enabled;
-    }
-    fn do_if<R: Read, W: Write>(
-        &mut self,
-        reader: &mut Bytes<R>,
-        writer: &mut W,
-        subinstrs: &[SmInstruction],
-    ) {
-        if self.active_var == self.inactive_var {
-            for subinstr in subinstrs {
-                self.run_instruction(reader, writer, subinstr)
-            }
-        }
-    }
-    fn do_while<R: Read, W: Write>(
+    /// Executes a flattened program on this machine. Execution is just a
+    /// program-counter loop: conditional structure was compiled down to
+    /// jumps during flattening.
+    fn run_flat<R: Read, W: Write>(
         &mut self,
         reader: &mut Bytes<R>,
         writer: &mut W,
-        subinstrs: &[SmInstruction],
+        program: &FlatProgram,
     ) {
-        while self.active_var > 0 {
-            for subinstr in subinstrs {
-                self.run_instruction(reader, writer, subinstr)
+        let ops = &program.ops;
+        let mut pc = 0;
+        // Fetching with get() does one bounds check per dispatch, which also
+        // doubles as the end-of-program check
+        while let Some(&op) = ops.get(pc) {
+            // The trivial ops are inlined right into their match arms; only
+            // the ones with real logic (I/O, error handling) are proxied to
+            // functions
+            match op {
+                FlatOp::ReadToActive => self.read_to_active(reader),
+                FlatOp::PrintActive => {
+                    self.print_active(writer);
+                }
+                FlatOp::PrintState => {
+                    self.print_state(writer);
+                }
+                FlatOp::AddActive(delta) => {
+                    self.active_var += delta;
+                }
+                FlatOp::SaveActive => {
+                    self.inactive_var = self.active_var;
+                }
+                FlatOp::Swap => {
+                    std::mem::swap(
+                        &mut self.active_var,
+                        &mut self.inactive_var,
+                    );
+                }
+                FlatOp::PushZero => {
+                    self.stack.push(0);
+                }
+                FlatOp::PushActive => {
+                    self.stack.push(self.active_var);
+                }
+                FlatOp::PopToActive => {
+                    self.pop_to_active();
+                }
+                FlatOp::SetActiveZero => {
+                    self.active_var = 0;
+                }
+                FlatOp::ToggleErrors => {
+                    self.errors_enabled = !self.errors_enabled;
+                }
+                FlatOp::JumpIfNe(target) => {
+                    if self.active_var != self.inactive_var {
+                        pc = target;
+                        continue;
+                    }
+                }
+                FlatOp::JumpIfNonPos(target) => {
+                    if self.active_var <= 0 {
+                        pc = target;
+                        continue;
+                    }
+                }
+                FlatOp::Jump(target) => {
+                    pc = target;
+                    continue;
+                }
+                FlatOp::FusedLoopAdd { decr, incr } => {
+                    if self.active_var > 0 {
+                        // The loop would run until active <= 0, i.e.
+                        // ceil(active / decr) times. decr is always > 0.
+                        let iterations =
+                            (self.active_var + decr - 1) / decr;
+                        self.active_var -= decr * iterations;
+                        self.inactive_var += incr * iterations;
+                    }
+                }
+                FlatOp::FusedLoopPushZero { decr, zeros } => {
+                    if self.active_var > 0 {
+                        // Same iteration count as FusedLoopAdd, but the
+                        // zeros all get pushed in one bulk fill
+                        let iterations =
+                            (self.active_var + decr - 1) / decr;
+                        self.active_var -= decr * iterations;
+                        self.stack.resize(
+                            self.stack.len() + zeros * iterations as usize,
+                            0,
+                        );
+                    }
+                }
+                FlatOp::DebugPrint(msg_index, print_stack) => {
+                    println!("[DEBUG] {}", &program.debug_msgs[msg_index]);
+                    if print_stack {
+                        self.write_stack(&mut io::stdout()).unwrap();
+                    }
+                }
             }
+            pc += 1;
         }
     }
 
-    /// Runs a single instruction on this machine.
-    fn run_instruction<R: Read, W: Write>(
+    /// Runs an already-flattened program on this machine, using the given
+    /// input and output. Use this over `run` when the same program gets
+    /// executed repeatedly, so the flattening cost is only paid once.
+    pub fn run_compiled<R: Read, W: Write>(
         &mut self,
-        reader: &mut Bytes<R>,
+        reader: R,
         writer: &mut W,
-        instruction: &SmInstruction,
+        program: &FlatProgram,
     ) {
-        // These are all proxied to functions to make it easier to profile
-        match instruction {
-            SmInstruction::ReadToActive => self.read_to_active(reader),
-            SmInstruction::PrintActive => {
-                self.print_active(writer);
-            }
-            SmInstruction::PrintState => {
-                self.print_state(writer);
-            }
-            SmInstruction::IncrActive => {
-                self.incr();
-            }
-            SmInstruction::DecrActive => {
-                self.decr();
-            }
-            SmInstruction::SaveActive => {
-                self.save_active();
-            }
-            SmInstruction::Swap => {
-                self.swap();
-            }
-            SmInstruction::PushZero => {
-                self.push_zero();
-            }
-            SmInstruction::PushActive => {
-                self.push_active();
-            }
-            SmInstruction::PopToActive => {
-                self.pop_to_active();
-            }
-            SmInstruction::ToggleErrors => {
-                self.toggle_errors();
-            }
-            SmInstruction::If(subinstrs) => {
-                self.do_if(reader, writer, subinstrs)
-            }
-            SmInstruction::While(subinstrs) => {
-                self.do_while(reader, writer, subinstrs);
-            }
-            SmInstruction::Comment(_) => {}
-            SmInstruction::InlineComment(subinstr, _) => {
-                self.run_instruction(reader, writer, subinstr)
-            }
-            SmInstruction::DebugPrint(msg, print_stack) => {
-                println!("[DEBUG] {}", &msg);
-                if *print_stack {
-                    self.write_stack(&mut io::stdout()).unwrap();
-                }
-            }
-        }
+        let mut reader_bytes = reader.bytes();
+        self.run_flat(&mut reader_bytes, writer, program)
     }
 
     /// Runs all given instructions on this machine, using the given input
-    /// and output.
+    /// and output. One-shot convenience wrapper around `run_compiled` -
+    /// real callers hold onto the flattened program and call that directly,
+    /// so this is only used by tests.
+    #[cfg(test)]
     pub fn run<R: Read, W: Write>(
         &mut self,
         reader: R,
         writer: &mut W,
         instructions: &[SmInstruction],
     ) {
-        let mut reader_bytes = reader.bytes();
-        for instruction in instructions {
-            self.run_instruction(&mut reader_bytes, writer, instruction)
-        }
+        let program = FlatProgram::flatten(instructions);
+        self.run_compiled(reader, writer, &program)
     }
 }
 
@@ -484,6 +760,77 @@ mod tests {
         assert_eq!(sm.stack, &[0, 0, 0]);
     }
 
+    #[test]
+    fn test_while_add_loop() {
+        let mut sm = StackMachine::new();
+        // A transfer loop - this compiles to the fused closed form, so it
+        // has to produce the same result the real loop would
+        run_machine(
+            &mut sm,
+            &[
+                IncrActive,
+                IncrActive,
+                IncrActive,
+                While(vec![DecrActive, Swap, IncrActive, Swap]),
+            ],
+        );
+        assert_eq!(sm.active_var, 0);
+        assert_eq!(sm.inactive_var, 3);
+    }
+
+    #[test]
+    fn test_while_countdown_loop() {
+        let mut sm = StackMachine::new();
+        // A bare-decrement body also compiles to the fused form. 5 isn't a
+        // multiple of 2, so the loop overshoots to -1, just like the real
+        // loop would.
+        run_machine(
+            &mut sm,
+            &[
+                IncrActive,
+                IncrActive,
+                IncrActive,
+                IncrActive,
+                IncrActive,
+                While(vec![DecrActive, DecrActive]),
+            ],
+        );
+        assert_eq!(sm.active_var, -1);
+        assert_eq!(sm.inactive_var, 0);
+    }
+
+    #[test]
+    fn test_while_zero_fill_loop() {
+        let mut sm = StackMachine::new();
+        // A zero-fill body compiles to one bulk stack fill. 5 isn't a
+        // multiple of 2, so the countdown overshoots to -1, with one zero
+        // pushed per iteration - same as the real loop
+        run_machine(
+            &mut sm,
+            &[
+                IncrActive,
+                IncrActive,
+                IncrActive,
+                IncrActive,
+                IncrActive,
+                While(vec![DecrActive, DecrActive, PushZero]),
+            ],
+        );
+        assert_eq!(sm.active_var, -1);
+        assert_eq!(sm.stack, &[0, 0, 0]);
+    }
+
+    #[test]
+    fn test_swap_pairs_cancel() {
+        let mut sm = StackMachine::new();
+        // Adjacent Swap pairs get peepholed away at flatten time (and the
+        // Incrs around them fold together) - the observable state has to
+        // come out the same as if everything really ran
+        run_machine(&mut sm, &[IncrActive, Swap, Swap, IncrActive]);
+        assert_eq!(sm.active_var, 2);
+        assert_eq!(sm.inactive_var, 0);
+    }
+
     #[test]
     fn test_comment() {
         let mut sm = StackMachine::new();
@@ -2,16 +2,18 @@ use crate::{
     ast::{Program, BLANK_CHAR},
     compile::Compile,
     error::RuntimeError,
-    stack::{SmInstruction, StackMachine},
+    exec::Executor,
+    stack::{FlatProgram, SmInstruction, StackMachine},
     validate::Validate,
 };
-use ascii::AsciiString;
+use ascii::AsciiStr;
 use failure::Error;
 use serde::Serialize;
 use std::{
+    cell::RefCell,
+    collections::HashMap,
     fmt::{self, Display, Formatter},
     io::{self, Write},
-    str::FromStr,
 };
 
 /// A Turing machine built entirely on Rocketlang's stack machine. This proves
@@ -23,14 +25,33 @@ use std::{
 /// This machine should not be exposed externally, because it assumes that the
 /// input states have been validated.
 ///
-/// This has the external API of a TM, but internally only uses the two-variable
-/// stack machine from Rocketlang.
+/// This has the external API of a TM. It can be compiled down to the
+/// two-variable stack machine from Rocketlang, but by default it executes the
+/// program directly, because the stack-machine encoding is extremely slow.
 ///
 /// The output of this machine is either "ACCEPT" or "REJECT". See the
 /// individual run functions to determine where the output destination is.
+///
+/// All per-program work is cached on the machine instance: the program is
+/// validated and compiled once in `new`, the stack-machine flattening
+/// happens at most once, and outputs are memoized per input. Reusing one
+/// machine across runs is therefore much cheaper than rebuilding it.
 #[derive(Debug, Serialize)]
 pub struct TuringMachine {
     instructions: Vec<SmInstruction>,
+    /// The instructions, flattened for execution. Built lazily on the first
+    /// stack-machine run: the direct executor never needs it, so machines
+    /// that stay on the fast path never pay the flattening cost. Once built,
+    /// repeated runs reuse it.
+    #[serde(skip)]
+    compiled_program: RefCell<Option<FlatProgram>>,
+    #[serde(skip)]
+    executor: Executor,
+    /// Cached output, keyed by input string. The machine is deterministic
+    /// and can't change after construction, so the output for a given input
+    /// never changes either.
+    #[serde(skip)]
+    output_cache: RefCell<HashMap<String, Vec<u8>>>,
 }
 
 impl TuringMachine {
@@ -39,11 +60,30 @@ impl TuringMachine {
     /// ensuring that the IDs are sequential, the initial state is in the array,
     /// etc.
     pub fn new(program: Program) -> Result<Self, Error> {
+        let program = program.validate_into(&())?;
+        let instructions = program.compile();
         Ok(Self {
-            instructions: program.validate_into(&())?.compile(),
+            compiled_program: RefCell::new(None),
+            instructions,
+            executor: Executor::new(&program),
+            output_cache: RefCell::new(HashMap::new()),
         })
     }
 
+    /// Validates the given input string. To be valid, the input has to be
+    /// ASCII and can't contain the blank char. Both checks are single passes
+    /// over the raw bytes, and the input is borrowed rather than copied.
+    fn validate_input(input: &str) -> Result<&AsciiStr, Error> {
+        let ascii_str = AsciiStr::from_ascii(input)?;
+
+        // A slice scan beats checking char-by-char
+        if ascii_str.as_bytes().contains(&BLANK_CHAR.as_byte()) {
+            return Err(RuntimeError::BlankCharInInput.into());
+        }
+
+        Ok(ascii_str)
+    }
+
     /// Helper function to execute the machine with the given input string and
     /// output destination.
     fn run_with_io<W: Write>(
@@ -51,19 +91,46 @@ impl TuringMachine {
         input: &str,
         output: &mut W,
     ) -> Result<(), Error> {
-        let ascii_str = AsciiString::from_str(&input)?;
-
-        for c in ascii_str.chars() {
-            if *c == BLANK_CHAR {
-                return Err(RuntimeError::BlankCharInInput.into());
-            }
+        // If we've already run on this input, just replay the output. Only
+        // valid inputs ever get cached, so a hit also means we can skip
+        // re-validating.
+        if let Some(cached) = self.output_cache.borrow().get(input) {
+            output.write_all(cached)?;
+            return Ok(());
         }
 
-        let mut machine = StackMachine::new();
-        machine.run(ascii_str.as_bytes(), output, &self.instructions);
+        let ascii_str = Self::validate_input(input)?;
+        let mut buffer = Vec::new();
+        self.executor.run(ascii_str, &mut buffer)?;
+        output.write_all(&buffer)?;
+        self.output_cache
+            .borrow_mut()
+            .insert(input.to_owned(), buffer);
         Ok(())
     }
 
+    /// Executes this machine on the given input, going through the full
+    /// stack-machine encoding instead of the direct executor. This is much
+    /// slower, but it's the path that proves the machine can really run on
+    /// Rocketlang. Returns a byte vector that contains all of the output from
+    /// the machine.
+    ///
+    /// The flattened program is compiled on the first call and cached on the
+    /// machine, so repeated runs only pay the compile cost once.
+    pub fn run_on_stack_machine(&self, input: &str) -> Result<Vec<u8>, Error> {
+        let ascii_str = Self::validate_input(input)?;
+
+        // Flatten on first use, then reuse the compiled program
+        let mut compiled = self.compiled_program.borrow_mut();
+        let program = compiled
+            .get_or_insert_with(|| FlatProgram::flatten(&self.instructions));
+
+        let mut output = Vec::new();
+        let mut machine = StackMachine::new();
+        machine.run_compiled(ascii_str.as_bytes(), &mut output, program);
+        Ok(output)
+    }
+
     /// Executes this machine on the given input. Uses stdout as the output
     /// stream.
     pub fn run(&self, input: &str) -> Result<(), Error> {
@@ -77,6 +144,17 @@ impl TuringMachine {
         self.run_with_io(input, &mut output_buffer)?;
         Ok(output_buffer)
     }
+
+    /// Executes this machine on each of the given inputs, returning one
+    /// output buffer per input, in order. Equivalent to calling
+    /// `run_with_output` in a loop, except repeated inputs only get executed
+    /// once, thanks to the output cache.
+    pub fn run_batch(&self, inputs: &[&str]) -> Result<Vec<Vec<u8>>, Error> {
+        inputs
+            .iter()
+            .map(|input| self.run_with_output(input))
+            .collect()
+    }
 }
 
 impl Display for TuringMachine {
@@ -95,7 +173,7 @@ mod tests {
         ast::{State, TapeInstruction, Transition},
         utils::assert_error,
     };
-    use ascii::AsciiChar;
+    use ascii::{AsciiChar, AsciiString};
 
     fn assert_tm(
         tm: &TuringMachine,
@@ -158,10 +236,9 @@ mod tests {
         assert_error("the byte at index 0 is not ASCII", tm.run("\u{80}"));
     }
 
-    #[test]
-    fn test_simple_machine() -> Result<(), Error> {
-        // Machine matches the string "foo"
-        let program = Program {
+    /// A program that matches exactly the string "foo"
+    fn foo_program() -> Program {
+        Program {
             states: vec![
                 State {
                     id: 1,
@@ -210,11 +287,208 @@ mod tests {
                     transitions: vec![],
                 },
             ],
-        };
-        let tm = TuringMachine::new(program).unwrap();
+        }
+    }
+
+    #[test]
+    fn test_simple_machine() -> Result<(), Error> {
+        let tm = TuringMachine::new(foo_program()).unwrap();
 
         assert_tm(&tm, "foo", true)?;
         assert_tm(&tm, "food", false)?;
         Ok(())
     }
+
+    #[test]
+    fn test_run_batch() -> Result<(), Error> {
+        let tm = TuringMachine::new(foo_program()).unwrap();
+
+        // Inputs are reversed, as always. "oof" repeats to hit the cache.
+        let outputs = tm.run_batch(&["oof", "doof", "oof"])?;
+        for (output, expected) in
+            outputs.into_iter().zip(&["ACCEPT", "REJECT", "ACCEPT"])
+        {
+            let output_string = AsciiString::from_ascii(output).unwrap();
+            assert!(output_string.trim().as_str().ends_with(expected));
+        }
+        Ok(())
+    }
+
+    /// A program that matches "ab" the hard way: it walks right to check the
+    /// 'b', then walks back left and overwrites the 'a' with an 'x' before
+    /// re-walking the whole string. Exercises the Left tape instruction.
+    fn left_move_program() -> Program {
+        Program {
+            states: vec![
+                State {
+                    id: 1,
+                    initial: true,
+                    accepting: false,
+                    transitions: vec![Transition {
+                        match_char: AsciiChar::a,
+                        tape_instruction: TapeInstruction::Right,
+                        next_state: 2,
+                    }],
+                },
+                State {
+                    id: 2,
+                    initial: false,
+                    accepting: false,
+                    transitions: vec![Transition {
+                        match_char: AsciiChar::b,
+                        tape_instruction: TapeInstruction::Left,
+                        next_state: 3,
+                    }],
+                },
+                State {
+                    id: 3,
+                    initial: false,
+                    accepting: false,
+                    transitions: vec![Transition {
+                        match_char: AsciiChar::a,
+                        tape_instruction: TapeInstruction::Write(AsciiChar::x),
+                        next_state: 4,
+                    }],
+                },
+                State {
+                    id: 4,
+                    initial: false,
+                    accepting: false,
+                    transitions: vec![Transition {
+                        match_char: AsciiChar::x,
+                        tape_instruction: TapeInstruction::Right,
+                        next_state: 5,
+                    }],
+                },
+                State {
+                    id: 5,
+                    initial: false,
+                    accepting: false,
+                    transitions: vec![Transition {
+                        match_char: AsciiChar::b,
+                        tape_instruction: TapeInstruction::Right,
+                        next_state: 6,
+                    }],
+                },
+                State {
+                    id: 6,
+                    initial: false,
+                    accepting: false,
+                    transitions: vec![Transition {
+                        match_char: AsciiChar::Null,
+                        tape_instruction: TapeInstruction::Right,
+                        next_state: 7,
+                    }],
+                },
+                State {
+                    id: 7,
+                    initial: false,
+                    accepting: true,
+                    transitions: vec![],
+                },
+            ],
+        }
+    }
+
+    #[test]
+    fn test_left_shift() -> Result<(), Error> {
+        // Run the Left instruction on both paths - the stack-machine
+        // encoding of the left shift is the trickiest codegen we have
+        let tm = TuringMachine::new(left_move_program()).unwrap();
+
+        for (input, expected) in &[("ab", "ACCEPT"), ("aa", "REJECT")] {
+            let reversed: String = input.chars().rev().collect();
+            let direct = tm.run_with_output(&reversed)?;
+            let on_sm = tm.run_on_stack_machine(&reversed)?;
+            let direct_str = AsciiString::from_ascii(direct).unwrap();
+            let on_sm_str = AsciiString::from_ascii(on_sm).unwrap();
+            assert!(direct_str.trim().as_str().ends_with(expected));
+            assert!(on_sm_str.trim().as_str().ends_with(expected));
+        }
+        Ok(())
+    }
+
+    #[test]
+    fn test_left_shift_at_tape_edge() -> Result<(), Error> {
+        // Moving left off the edge of the tape reads a blank - this is the
+        // case where the encoded left tape is an exact multiple of
+        // ALPHABET_SIZE (namely zero)
+        let tm = TuringMachine::new(Program {
+            states: vec![
+                State {
+                    id: 1,
+                    initial: true,
+                    accepting: false,
+                    transitions: vec![Transition {
+                        match_char: AsciiChar::b,
+                        tape_instruction: TapeInstruction::Left,
+                        next_state: 2,
+                    }],
+                },
+                State {
+                    id: 2,
+                    initial: false,
+                    accepting: false,
+                    transitions: vec![Transition {
+                        match_char: AsciiChar::Null,
+                        tape_instruction: TapeInstruction::Right,
+                        next_state: 3,
+                    }],
+                },
+                State {
+                    id: 3,
+                    initial: false,
+                    accepting: false,
+                    transitions: vec![Transition {
+                        match_char: AsciiChar::b,
+                        tape_instruction: TapeInstruction::Right,
+                        next_state: 4,
+                    }],
+                },
+                State {
+                    id: 4,
+                    initial: false,
+                    accepting: false,
+                    transitions: vec![Transition {
+                        match_char: AsciiChar::Null,
+                        tape_instruction: TapeInstruction::Right,
+                        next_state: 5,
+                    }],
+                },
+                State {
+                    id: 5,
+                    initial: false,
+                    accepting: true,
+                    transitions: vec![],
+                },
+            ],
+        })
+        .unwrap();
+
+        let direct = tm.run_with_output("b")?;
+        let on_sm = tm.run_on_stack_machine("b")?;
+        let direct_str = AsciiString::from_ascii(direct).unwrap();
+        let on_sm_str = AsciiString::from_ascii(on_sm).unwrap();
+        assert!(direct_str.trim().as_str().ends_with("ACCEPT"));
+        assert!(on_sm_str.trim().as_str().ends_with("ACCEPT"));
+        Ok(())
+    }
+
+    #[test]
+    fn test_stack_machine_parity() -> Result<(), Error> {
+        // The direct executor and the stack-machine encoding have to agree
+        let tm = TuringMachine::new(foo_program()).unwrap();
+
+        for (input, expected) in &[("foo", "ACCEPT"), ("food", "REJECT")] {
+            // Reverse the input, as always
+            let reversed: String = input.chars().rev().collect();
+            let direct = tm.run_with_output(&reversed)?;
+            let on_sm = tm.run_on_stack_machine(&reversed)?;
+            let direct_str = AsciiString::from_ascii(direct).unwrap();
+            let on_sm_str = AsciiString::from_ascii(on_sm).unwrap();
+            assert!(direct_str.trim().as_str().ends_with(expected));
+            assert!(on_sm_str.trim().as_str().ends_with(expected));
+        }
+        Ok(())
+    }
 }